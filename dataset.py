@@ -2,7 +2,7 @@ import torch
 from torch.utils.data import Dataset
 from transformers import BertTokenizer, BertModel
 import cv2
-from graph_utils import pad_encodings, load_graph_data, load_json
+from graph_utils import pad_encodings, load_graph_data, load_json, invert_vocab
 from PIL import Image
 from torchvision.transforms import ToTensor
 
@@ -27,20 +27,18 @@ def collate_fn_classifier(data, triplet_to_idx):
     images = images/255
     
     triplets_tensor = torch.zeros((len(triplets),len(triplet_to_idx))) # To store one hot encodings
-    
-    i=0
-    # print(triplets)
-    # exit(0)
+
+    # Fill one row of the tensor for each sample of the batch
     # Added this try except for rsicd dataset
-    try:
-        for image_triplet in triplets[0]:
-            for triplet in image_triplet:
-                triplets_tensor[i,triplet_to_idx[str(tuple(triplet))]] = 1
-    except:
-        for image_triplet in [triplets[0]]:
-            for triplet in image_triplet:
+    for i, image_triplets in enumerate(triplets):
+        try:
+            for image_triplet in image_triplets:
+                for triplet in image_triplet:
+                    triplets_tensor[i,triplet_to_idx[str(tuple(triplet))]] = 1
+        except:
+            for triplet in image_triplets:
                 triplets_tensor[i,triplet_to_idx[str(tuple(triplet))]] = 1
-    
+
     return images, triplets_tensor
 
 
@@ -75,55 +73,43 @@ def collate_fn_captions(data, word2idx, training):
     for i, elem in enumerate(node_feats):
         new_feats[i] = elem
     
-    # Create the captions tensor
-    new_cap_ids = []
-    for d in data:
-        smth = []
-        for cap in d['captions']:
-            tmp = [word2idx[word] if word in word2idx else word2idx['<unk>'] for word in cap]
-            smth.append(tmp)
-        new_cap_ids.append(smth)
+    # Captions were already encoded to ids at dataset build time
+    new_cap_ids = [d['caption_ids'] for d in data]
 
-    return [d['imgid'] for d in data], [d['captions'] for d in data], pad_encodings(new_cap_ids, word2idx['<pad>'], training=training), src_ids, dst_ids, new_feats, num_nodes
+    return [d['imgid'] for d in data], new_cap_ids, pad_encodings(new_cap_ids, word2idx['<pad>'], training=training), src_ids, dst_ids, new_feats, num_nodes
 
 def collate_fn_waterfall(data, word2idx, training, pil):
     '''
     Collate function for the graph to caption in the waterfall pipeline
     '''
     
-    # Create the captions tensor
+    # Captions were already encoded to ids at dataset build time
     new_cap_ids = []
     cap_length = []
     index = torch.randperm(len(data[0]['captions']))[:1]
     for d in data:
-        # smth = []
-        # smth_len = []
-        # for cap in d['captions']:
-        #     tmp = [word2idx[word] if word in word2idx else word2idx['<unk>'] for word in cap]
-        #     smth_len.append(len(cap))
-        #     smth.append(tmp)
-        tmp = [word2idx[word] if word in word2idx else word2idx['<unk>'] for word in d['captions'][index]]
+        tmp = d['caption_ids'][index]
         new_cap_ids.append(tmp)
         cap_length.append(len(tmp))
-    
+
     def argsort(seq, reverse):
         # http://stackoverflow.com/questions/3071415/efficient-method-to-calculate-the-rank-vector-of-a-list-in-python
         return sorted(range(len(seq)), key=seq.__getitem__, reverse=reverse)
-    
+
     sorted_indexes = argsort(cap_length, True)
-    
+
     new_cap_ids = [new_cap_ids[id] for id in sorted_indexes]
     cap_length = [cap_length[id] for id in sorted_indexes]
     images = [data[id]['image'] for id in sorted_indexes]
     triplets = [data[id]['triplets'] for id in sorted_indexes]
-        
+
     images = torch.stack(images, 0)
     if not pil:
         images = images.permute(0,3,1,2)
     images = images/255
-    
-    
-    return [data[id]['imgid'] for id in sorted_indexes], images, triplets, [data[id]['captions'][index] for id in sorted_indexes], pad_encodings(new_cap_ids, word2idx['<pad>'], index, training=training), cap_length
+
+
+    return [data[id]['imgid'] for id in sorted_indexes], images, triplets, new_cap_ids, pad_encodings(new_cap_ids, word2idx['<pad>'], index, training=training), cap_length
 
 
 def augmented_collate_fn(data, word2idx, training):
@@ -164,16 +150,10 @@ def augmented_collate_fn(data, word2idx, training):
     for i, elem in enumerate(node_feats):
         new_feats[i] = elem
     
-    # Create the captions tensor
-    new_cap_ids = []
-    for d in data:
-        smth = []
-        for cap in d['captions']:
-            tmp = [word2idx[word] if word in word2idx else word2idx['<unk>'] for word in cap]
-            smth.append(tmp)
-        new_cap_ids.append(smth)
+    # Captions were already encoded to ids at dataset build time
+    new_cap_ids = [d['caption_ids'] for d in data]
 
-    return [d['imgid'] for d in data], images, [d['captions'] for d in data], pad_encodings(new_cap_ids, word2idx['<pad>'], training=training), src_ids, dst_ids, new_feats, num_nodes
+    return [d['imgid'] for d in data], images, new_cap_ids, pad_encodings(new_cap_ids, word2idx['<pad>'], training=training), src_ids, dst_ids, new_feats, num_nodes
 
 
 
@@ -182,18 +162,12 @@ def collate_fn_full(data, triplet_to_idx, word2idx, training, pil):
     Collate function to train the full pipeline
     '''
     
-     # Create the captions tensor
+     # Captions were already encoded to ids at dataset build time
     new_cap_ids = []
     cap_length = []
     index = torch.randperm(len(data[0]['captions']))[:1]
     for d in data:
-        # smth = []
-        # smth_len = []
-        # for cap in d['captions']:
-        #     tmp = [word2idx[word] if word in word2idx else word2idx['<unk>'] for word in cap]
-        #     smth_len.append(len(cap))
-        #     smth.append(tmp)
-        tmp = [word2idx[word] if word in word2idx else word2idx['<unk>'] for word in d['captions'][index]]
+        tmp = d['caption_ids'][index]
         new_cap_ids.append(tmp)
         cap_length.append(len(tmp))
     
@@ -256,7 +230,7 @@ def collate_fn_full(data, triplet_to_idx, word2idx, training, pil):
     
     
     
-    return [data[id]['imgid'] for id in sorted_indexes], images, triplets_tensor, [data[id]['captions'][index] for id in sorted_indexes], pad_encodings(new_cap_ids, word2idx['<pad>'], index, training=training), cap_length, src_ids, dst_ids, new_feats, num_nodes
+    return [data[id]['imgid'] for id in sorted_indexes], images, triplets_tensor, new_cap_ids, pad_encodings(new_cap_ids, word2idx['<pad>'], index, training=training), cap_length, src_ids, dst_ids, new_feats, num_nodes
 
 ################################################
 
@@ -267,15 +241,25 @@ class TripletDataset(Dataset):
     def __init__(self, graph_path: str, word2idx_path: str, return_keys: list, split: str) -> None:
         # Return keys
         self._return_keys = return_keys
-        # Word2idx
+        # Word2idx (with the cached id -> token conversion)
         self._word2idx = load_json(word2idx_path)
+        self._idx2word = invert_vocab(self._word2idx)
         # Graph data
         self._dst_ids, self._src_ids, self._node_feats, self._num_nodes = load_graph_data(graph_path=graph_path, split=split)
+        # Convert the node features to tensors once instead of on every
+        # __getitem__ (the collate functions copy them into fresh batch
+        # tensors anyway, so there is nothing to gain from pinning here)
+        for id in self._node_feats:
+            self._node_feats[id] = torch.Tensor(self._node_feats[id])
     
     @property
     def word2idx(self):
         return self._word2idx
-    
+
+    @property
+    def idx2word(self):
+        return self._idx2word
+
     @property
     def return_keys(self):
         return self._return_keys
@@ -305,12 +289,15 @@ class TripletDataset(Dataset):
         # Get the image ID
         id = list(self.triplets.keys())[index]
         try:
-            sample = {'image': self.images[int(id)], 'imgid': id, 'triplets': self.triplets[id], 'captions': self.captions[int(id)], 'src_ids':self.src_ids[id], 'dst_ids':self.dst_ids[id], 'node_feats': torch.Tensor(self.node_feats[id]), 'num_nodes': self.num_nodes[id]}
+            sample = {'image': self.images[int(id)], 'imgid': id, 'triplets': self.triplets[id], 'captions': self.captions[int(id)], 'caption_ids': self.caption_ids[int(id)], 'src_ids':self.src_ids[id], 'dst_ids':self.dst_ids[id], 'node_feats': self.node_feats[id], 'num_nodes': self.num_nodes[id]}
         except:
-            sample = {'image': self.images[id], 'imgid': id, 'triplets': self.triplets[id], 'captions': self.captions[int(id)], 'src_ids':self.src_ids[id], 'dst_ids':self.dst_ids[id], 'node_feats': torch.Tensor(self.node_feats[id]), 'num_nodes': self.num_nodes[id]}
-        # Filter only what is needed 
+            sample = {'image': self.images[id], 'imgid': id, 'triplets': self.triplets[id], 'captions': self.captions[int(id)], 'caption_ids': self.caption_ids[int(id)], 'src_ids':self.src_ids[id], 'dst_ids':self.dst_ids[id], 'node_feats': self.node_feats[id], 'num_nodes': self.num_nodes[id]}
+        # Filter only what is needed
         out = { your_key: sample[your_key] for your_key in self.return_keys}
-        
+        # The pre-encoded captions always travel together with the raw ones
+        if 'captions' in out:
+            out['caption_ids'] = sample['caption_ids']
+
         return out
 
 class UCMDataset(TripletDataset):
@@ -355,15 +342,18 @@ class UCMDataset(TripletDataset):
                     self.images[id] = torch.from_numpy(img.copy())
                 
         
-        # FOR TRIPLET CLASSIFICATION
+        # FOR TRIPLET CLASSIFICATION (with the cached id -> triplet conversion)
         self.triplet_to_idx = polished_data['Triplet_to_idx']
+        self.idx2triplet = invert_vocab(self.triplet_to_idx)
         if split is None:
             self.triplets = {id:value for (id,value) in polished_data.items() if id not in discarded_ids}
         else:
             self.triplets = {id:value for (id,value) in polished_data[split].items() if id not in discarded_ids}
             
-        # Captions part
+        # Captions part (tokens are encoded to ids once here, so the collate
+        # functions don't redo the word2idx lookups every batch)
         self.captions = {}
+        self.caption_ids = {}
         self.max_capt_length = 0
         for anno in readfile(caption_path):
             id = int(anno.split(" ")[:1][0])
@@ -379,8 +369,10 @@ class UCMDataset(TripletDataset):
                         self.max_capt_length = len(sentence)
                 try:
                     self.captions[id].append(sentence)
+                    self.caption_ids[id].append(tmp)
                 except:
                     self.captions[id] = [sentence]
+                    self.caption_ids[id] = [tmp]
 
 
             
@@ -404,6 +396,7 @@ class RSICDDataset(TripletDataset):
         # Polished triplets parts
         self.triplets = load_json(polished_tripl_path)[split]
         self.triplet_to_idx = load_json(polished_tripl_path)['Triplet_to_idx']
+        self.idx2triplet = invert_vocab(self.triplet_to_idx)
         # Save annotations
         self.annotations = load_json(annotation_path)['images']
         # IMG read for CV part
@@ -418,8 +411,10 @@ class RSICDDataset(TripletDataset):
                 # print("Path: ", path)
                 img = cv2.imread(path)[:,:,::-1] # CV2 reads images in BGR, so convert to RGB for the networks 
                 self.images[anno['imgid']] = torch.from_numpy(img.copy())
-        # Captions part
+        # Captions part (tokens are encoded to ids once here, so the collate
+        # functions don't redo the word2idx lookups every batch)
         self.captions = {}
+        self.caption_ids = {}
         self.max_capt_length = 0
         for anno in self.annotations:
             if anno['split']==split:
@@ -435,8 +430,10 @@ class RSICDDataset(TripletDataset):
                             self.max_capt_length = len(sentence)
                     try:
                         self.captions[anno['imgid']].append(sentence)
+                        self.caption_ids[anno['imgid']].append(tmp)
                     except:
                         self.captions[anno['imgid']] = [sentence]
+                        self.caption_ids[anno['imgid']] = [tmp]
 
 
 
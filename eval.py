@@ -1,15 +1,40 @@
+import os
 from torch.utils.data import DataLoader
 import torch
 from tqdm import tqdm
-import dgl
-from graph_utils import bleuFormat, decode_output, get_node_features, tripl2graphw, fixed_decode_output
+from graph_utils import bleuFormat, build_batched_graph, dump_json, decode_output, get_node_features, tripl2graphw, fixed_decode_output
 import json
 from functools import partial
 from dataset import collate_fn_captions, collate_fn_classifier, augmented_collate_fn, collate_fn_full, collate_fn_waterfall
 from numpy import argmax
 from torchmetrics.functional import f1_score
 from pycocoevalcap.bleu.bleu import Bleu
-from transformers import BertModel, BertTokenizer
+from models import _load_bert
+
+# Built once: the scorer is stateless across calls
+_bleu_scorer = Bleu(4)
+
+
+def _make_loader(dataset, collate_fn, batch_size):
+    '''
+    Function that builds a tuned DataLoader for evaluation
+
+    Args:
+        dataset (torch.utils.data.Dataset): dataset to iterate over
+        collate_fn: collate function for the batches
+        batch_size (int): size of the batches
+
+    Return:
+        loader (torch.utils.data.DataLoader): loader that overlaps loading with inference
+    '''
+    num_workers = min(8, os.cpu_count() or 1)
+    kwargs = dict(batch_size=batch_size, shuffle=False, collate_fn=collate_fn,
+                  num_workers=num_workers, pin_memory=torch.cuda.is_available())
+    if num_workers > 0:
+        # Keep the workers alive and a few batches ahead of the GPU
+        kwargs['persistent_workers'] = True
+        kwargs['prefetch_factor'] = 4
+    return DataLoader(dataset, **kwargs)
 
 
 
@@ -25,26 +50,30 @@ def eval_captions(dataset, model, filename):
     Return:
         None
     '''
-    testloader = DataLoader(dataset, batch_size=1, shuffle=False, collate_fn=partial(collate_fn_captions, word2idx=dataset.word2idx, training=True))
+    testloader = _make_loader(dataset, partial(collate_fn_captions, word2idx=dataset.word2idx, training=True), batch_size=32)
     # Set the correct device
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     model = model.to(device)
-    # Create the conversion id -> token
-    idx2word = {v: k for k, v in dataset.word2idx.items()}
-    with torch.no_grad():
+    if hasattr(torch, 'compile'):
+        # Fuse the GNN + decoder kernels and cut launch overhead
+        model = torch.compile(model, mode='reduce-overhead')
+    # Use the conversion id -> token cached by the dataset
+    idx2word = dataset.idx2word
+    with torch.inference_mode():
         model.eval()
         result = {}
         for _, data in enumerate(tqdm(testloader)):
             ids, _, encoded_captions, src_ids, dst_ids, node_feats, num_nodes = data
-            graphs = dgl.batch([dgl.graph((src_id, dst_id)) for src_id, dst_id in zip(src_ids, dst_ids)]).to(device)
+            graphs = build_batched_graph(src_ids, dst_ids, num_nodes, device)
             feats = get_node_features(node_feats, sum(num_nodes)).to(device)
-            outputs = model(graphs, feats, encoded_captions)
+            # Frozen backbones: bf16 autocast halves the memory traffic on GPU
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=(device.type == 'cuda')):
+                outputs = model(graphs, feats, encoded_captions)
             decoded_outputs = decode_output(outputs, idx2word)
             for i, id in enumerate(ids):
                 result[id] = {"caption length": len(decoded_outputs[i]),"caption ": decoded_outputs[i]}
             
-    with open(filename, "w") as outfile:
-        json.dump(result, outfile)
+    dump_json(result, filename)
         
 
 def augmented_eval_captions(dataset, model, filename):
@@ -59,27 +88,31 @@ def augmented_eval_captions(dataset, model, filename):
     Return:
         None
     '''
-    testloader = DataLoader(dataset, batch_size=1, shuffle=False, collate_fn=partial(augmented_collate_fn, word2idx=dataset.word2idx, training=True))
+    testloader = _make_loader(dataset, partial(augmented_collate_fn, word2idx=dataset.word2idx, training=True), batch_size=32)
     # Set the correct device
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     model = model.to(device)
-    # Create the conversion id -> token
-    idx2word = {v: k for k, v in dataset.word2idx.items()}
-    with torch.no_grad():
+    if hasattr(torch, 'compile'):
+        # Fuse the GNN + decoder kernels and cut launch overhead
+        model = torch.compile(model, mode='reduce-overhead')
+    # Use the conversion id -> token cached by the dataset
+    idx2word = dataset.idx2word
+    with torch.inference_mode():
         model.eval()
         result = {}
         for _, data in enumerate(tqdm(testloader)):
             ids, images, _, encoded_captions, src_ids, dst_ids, node_feats, num_nodes = data
-            graphs = dgl.batch([dgl.graph((src_id, dst_id)) for src_id, dst_id in zip(src_ids, dst_ids)]).to(device)
+            graphs = build_batched_graph(src_ids, dst_ids, num_nodes, device)
             feats = get_node_features(node_feats, sum(num_nodes)).to(device)
             img = images.to(device)
-            outputs = model(graphs, feats, img, encoded_captions)
+            # Frozen backbones: bf16 autocast halves the memory traffic on GPU
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=(device.type == 'cuda')):
+                outputs = model(graphs, feats, img, encoded_captions)
             decoded_outputs = decode_output(outputs, idx2word)
             for i, id in enumerate(ids):
                 result[id] = {"caption length": len(decoded_outputs[i]),"caption ": decoded_outputs[i]}
             
-    with open(filename, "w") as outfile:
-        json.dump(result, outfile)
+    dump_json(result, filename)
     
     bleuFormat(filename)
 
@@ -96,43 +129,48 @@ def eval_classification(dataset, model, filename, verbose=False):
     Return:
         None
     '''
-    # Create the dataloader
-    testloader = DataLoader(dataset, batch_size=1, shuffle=False, collate_fn=partial(collate_fn_classifier, triplet_to_idx=dataset.triplet_to_idx))
+    # Create the dataloader (the collate_fn builds the one hot encodings for the whole batch)
+    testloader = _make_loader(dataset, partial(collate_fn_classifier, triplet_to_idx=dataset.triplet_to_idx), batch_size=32)
     # Set the correct device
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     model = model.to(device)
-    # Create the conversion id -> triplet
-    idx2triplet = {v: k for k, v in dataset.triplet_to_idx.items()}
-    with torch.no_grad():
+    # Use the conversion id -> triplet cached by the dataset
+    idx2triplet = dataset.idx2triplet
+    with torch.inference_mode():
         model.eval()
-        accuracy_test = 0 
+        accuracy_test = 0.0
+        n_batches = 0
         for i, data in enumerate(tqdm(testloader)):
             images, triplets = data
             images = images.to(device)
             triplets = triplets.to(device)
-            outputs = model(images)
+            # Frozen backbone: bf16 autocast halves the memory traffic on GPU
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=(device.type == 'cuda')):
+                outputs = model(images)
             # Reshape with the right size
             outputs = outputs.reshape((outputs.shape[0], int(outputs.shape[1]/2), 2))
             # Calculate accuracy on training
             outputs = torch.sigmoid(outputs)
-            outputs = torch.tensor([[torch.argmax(task).item() for task in sample ] for sample in outputs]).to(outputs.device)
+            # Vectorized argmax keeps the predictions on device (no per-logit .item() sync)
+            outputs = outputs.argmax(dim=-1)
             accuracy = f1_score(outputs, triplets.long(), num_classes=2, mdmc_average='global')
             
             
-            outputs = outputs.nonzero()
-            triplets = triplets.nonzero()
-            
-            if(True):
-                print('True triplets')
-                for i in range(triplets.shape[0]):
-                    print(idx2triplet[triplets[i][1].item()])
-                print('Predicted triplets')
-                for i in range(outputs.shape[0]):
-                    print(idx2triplet[outputs[i][1].item()])
-                    
-            accuracy_test += accuracy
-    
-    print('Test accuracy: {:.3f}'.format(accuracy_test/i))
+            if verbose:
+                # Single transfer and a single print: no per-triplet GPU sync
+                pred_ids = outputs.nonzero()[:, 1].cpu().tolist()
+                true_ids = triplets.nonzero()[:, 1].cpu().tolist()
+                lines = ['True triplets']
+                lines += [str(idx2triplet[idx]) for idx in true_ids]
+                lines.append('Predicted triplets')
+                lines += [str(idx2triplet[idx]) for idx in pred_ids]
+                print('\n'.join(lines))
+
+            # Accumulate on device and sync only once after the loop
+            accuracy_test += accuracy.detach()
+            n_batches += 1
+
+    print('Test accuracy: {:.3f}'.format(float(accuracy_test)/n_batches))
         
         
         
@@ -148,27 +186,28 @@ def eval_pipeline(dataset, model, filename, pil):
     Return:
         None
     '''
-    testloader = DataLoader(dataset, batch_size=1, shuffle=False, collate_fn=partial(collate_fn_full, triplet_to_idx=dataset.triplet_to_idx, word2idx=dataset.word2idx, training=True, pil=pil))
+    testloader = _make_loader(dataset, partial(collate_fn_full, triplet_to_idx=dataset.triplet_to_idx, word2idx=dataset.word2idx, training=True, pil=pil), batch_size=1)
     # Set the correct device
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     model = model.to(device)
-    # Create the conversion id -> token
-    idx2word = {v: k for k, v in dataset.word2idx.items()}
-    with torch.no_grad():
+    # Use the conversion id -> token cached by the dataset
+    idx2word = dataset.idx2word
+    with torch.inference_mode():
         model.eval()
         result = {}
         for _, data in enumerate(tqdm(testloader)):
             ids, images, _, captions, encoded_captions, lengths, _, _, _, _ = data
             images = images.to(device)
-            cap_output = model.sample(images)
+            # Frozen backbones: bf16 autocast halves the memory traffic on GPU
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=(device.type == 'cuda')):
+                cap_output = model.sample(images)
             # decoded_outputs = decode_output(cap_outputs, idx2word)
             #decoded_outputs = fixed_decode_output(cap_output, idx2word)
             decode_output = [idx2word[idx] for idx in cap_output]
             for _, id in enumerate(ids):
                 result[id] = {"caption length": len(decode_output),"caption ": decode_output}
             
-    with open(filename, "w") as outfile:
-        json.dump(result, outfile) 
+    dump_json(result, filename)
     # Transform the output in bleu Format for the evaluation
     bleuFormat(filename)
     
@@ -184,15 +223,15 @@ def eval_waterfall(dataset, model, filename, pil):
     Return:
         None
     '''
-    testloader = DataLoader(dataset, batch_size=1, shuffle=False, collate_fn=partial(collate_fn_waterfall, word2idx=dataset.word2idx, training=True, pil=pil))
+    testloader = _make_loader(dataset, partial(collate_fn_waterfall, word2idx=dataset.word2idx, training=True, pil=pil), batch_size=1)
     # Set the correct device
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     model = model.to(device)
-    feature_encoder = BertModel.from_pretrained("bert-base-uncased")
-    tokenizer = BertTokenizer.from_pretrained("bert-base-uncased")
-    # Create the conversion id -> token
-    idx2word = {v: k for k, v in dataset.word2idx.items()}
-    with torch.no_grad():
+    # Shared frozen BERT (loaded once, cached across calls)
+    feature_encoder, tokenizer = _load_bert()
+    # Use the conversion id -> token cached by the dataset
+    idx2word = dataset.idx2word
+    with torch.inference_mode():
         model.eval()
         result = {}
         for _, data in enumerate(tqdm(testloader)):
@@ -200,14 +239,15 @@ def eval_waterfall(dataset, model, filename, pil):
             graphs, graph_feats = tripl2graphw(triplets, feature_encoder, tokenizer)
             graphs, graph_feats = graphs.to(device), graph_feats.to(device)
             # img = img.to(device)
-            outputs = model.sample(graphs, graph_feats)
+            # Frozen backbones: bf16 autocast halves the memory traffic on GPU
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=(device.type == 'cuda')):
+                outputs = model.sample(graphs, graph_feats)
             # decoded_outputs = fixed_decode_output(outputs, idx2word)
             decoded_output = [idx2word[idx] for idx in outputs]
             for _, id in enumerate(ids):
                 result[id] = {"caption length": len(decoded_output),"caption ": decoded_output}
             
-    with open(filename, "w") as outfile:
-        json.dump(result, outfile)
+    dump_json(result, filename)
     # Transform the output in bleu Format for the evaluation
     bleuFormat(filename)
     
@@ -222,16 +262,10 @@ def eval_predictions(predictions, ground_truth):
     Return:
         print the bleu scores
     '''
-    scorers = [
-            (Bleu(4), ["Bleu_1", "Bleu_2", "Bleu_3", "Bleu_4"]),
-        ]
-    for scorer, _ in scorers:
-        score, _ = scorer.compute_score(ground_truth, predictions)
-        score = [str(round(sc*100,2)) for sc in score]
-        for i in range(len(score)):
-            print('BLEU '+str(i))
-            print(score[i])
-    
+    scores, _ = _bleu_scorer.compute_score(ground_truth, predictions)
+    for i, score in enumerate(scores, start=1):
+        print(f'BLEU {i}: {score*100:.2f}')
+
     return
 
 
@@ -171,15 +171,17 @@ def _encode_seq_to_arr(seq, vocab2idx, max_seq_len) -> torch.Tensor:
 
 def encode_seq_to_arr_loss(sequence, vocab2idx, max_seq_len) -> torch.Tensor:
     '''
-    Function that encodes a sequence in the model loss(used internally)
+    Function that pads a pre-encoded sequence in the model loss (used internally).
+    The captions are already encoded to ids at dataset build time.
     '''
-    seq = [seq[:max_seq_len] + ["<pad>"] * max(0, max_seq_len - len(seq)) for seq in sequence]
-    return torch.tensor([vocab2idx[w] if w in vocab2idx else vocab2idx["<unk>"] for x in seq for w in x], dtype=torch.int64)
+    pad_id = vocab2idx["<pad>"]
+    seq = [seq[:max_seq_len] + [pad_id] * max(0, max_seq_len - len(seq)) for seq in sequence]
+    return torch.tensor([w for x in seq for w in x], dtype=torch.int64)
 
 def fixed_seq_to_arr(sequence, vocab2idx, max_seq_len):
-    seq = [seq[:max_seq_len] + ["<pad>"] * max(0, max_seq_len - len(seq)) for seq in sequence]
-    # print("\nSequence: ", len(seq), len(seq[0]), len(seq[0][0]))
-    res = torch.tensor([[vocab2idx[x] if x in vocab2idx else vocab2idx["<unk>"] for x in s ] for s in seq], dtype=torch.int64)
+    # The captions are already encoded to ids at dataset build time, only pad
+    pad_id = vocab2idx["<pad>"]
+    res = torch.tensor([s[:max_seq_len] + [pad_id] * max(0, max_seq_len - len(s)) for s in sequence], dtype=torch.int64)
     # print(res.shape)
     return res
 
@@ -3,6 +3,11 @@ import sng_parser
 from gensim.models import Word2Vec
 import torch
 import json
+# orjson serializes roughly 3x faster than the stdlib, but keep it optional
+try:
+    import orjson
+except ImportError:
+    orjson = None
 import dgl
 import matplotlib.pyplot as plt
 
@@ -96,6 +101,23 @@ def create_feats(sentences, save_model=False, loaded_model=None, tokenize=False,
     else:
         return model
 
+def invert_vocab(vocab2idx):
+    '''
+    Build the id -> token conversion once as a plain list
+    (a list index beats a dict lookup for the int -> str decoding)
+
+    Args:
+        vocab2idx: dictionary token -> id
+
+    Return:
+        idx2vocab: list where position id holds the corresponding token
+    '''
+    idx2vocab = [None] * (max(vocab2idx.values()) + 1)
+    for k, v in vocab2idx.items():
+        idx2vocab[v] = k
+    return idx2vocab
+
+
 def get_node_features(features, num_nodes):
     '''
     Given the padded node features, extract the original ones
@@ -107,40 +129,75 @@ def get_node_features(features, num_nodes):
     Return:
         new_feats: tensor with the features for each node (total_num_nodes, feat_size)
     '''
+    # Vectorized version of the old per-row Python loop: drop the all-zero
+    # padding rows in one masked select, keeping the original row order
+    flat = features.reshape(-1, features.size(-1))
+    valid = flat[flat.sum(dim=-1) != 0.0]
     new_feats = torch.zeros((num_nodes, features.size(-1)))
-    checkpoint = 0
-    for sample in features:
-        for feat in sample:
-            if sum(feat) == 0.0:
-                continue
-            else:
-                new_feats[checkpoint] = feat
-                checkpoint+=1
-    
+    new_feats[:valid.size(0)] = valid
+
     return new_feats
             
             
+def build_batched_graph(src_ids, dst_ids, num_nodes, device=None):
+    '''
+    Build the batched DGLGraph of a whole batch in one shot, directly on the
+    target device, instead of creating one CPU graph per sample and copying
+    the result of dgl.batch afterwards.
+
+    Args:
+        src_ids: list of source node id lists, one per sample
+        dst_ids: list of destination node id lists, one per sample
+        num_nodes: list with the number of nodes of each sample
+        device: device on which the graph is created
+
+    Return:
+        g (dgl.DGLGraph): batched graph equivalent to dgl.batch of the samples
+    '''
+    src_cat = []
+    dst_cat = []
+    num_edges = []
+    offset = 0
+    for src, dst, n in zip(src_ids, dst_ids, num_nodes):
+        src_cat.extend([s + offset for s in src])
+        dst_cat.extend([d + offset for d in dst])
+        num_edges.append(len(src))
+        offset += n
+    # int32 ids take the fast path of the DGL kernels
+    src_cat = torch.tensor(src_cat, dtype=torch.int32, device=device)
+    dst_cat = torch.tensor(dst_cat, dtype=torch.int32, device=device)
+    g = dgl.graph((src_cat, dst_cat), num_nodes=offset, device=device)
+    # Keep the per-sample boundaries so readout/pooling still sees the batch
+    g.set_batch_num_nodes(torch.tensor(num_nodes, dtype=torch.int32, device=device))
+    g.set_batch_num_edges(torch.tensor(num_edges, dtype=torch.int32, device=device))
+    return g
+
+
 def decode_output(out, idx2word):
     '''
     Function that decodes the network's output into the actual captions
     '''
     sentences = [[] for _ in range(out[0].size(0))]
     for toks in out:
-        for i, sample in enumerate(toks):
-            sentences[i].append(argmax(sample.cpu().detach().numpy()))
+        # torch.argmax instead of the numpy one: the outputs can be bf16
+        # under autocast, which numpy cannot represent
+        for i, id in enumerate(toks.detach().argmax(dim=-1).cpu().tolist()):
+            sentences[i].append(id)
     
     for j, sent in enumerate(sentences):
         for i, id in enumerate(sent):
             sentences[j][i] = idx2word[id]
-    try:
-        sentences = [sent[:sent.index("<eos>")+1] for sent in sentences]
-    except:
+    # Truncate each caption on its own: with batched decoding, one sentence
+    # without <eos> must not leave the rest of the batch untruncated
+    for j, sent in enumerate(sentences):
         try:
-            sentences = [sent[:sent.index("<pad>")] for sent in sentences]
-        except:
-            print(sentences)
-        
-    
+            sentences[j] = sent[:sent.index("<eos>")+1]
+        except ValueError:
+            try:
+                sentences[j] = sent[:sent.index("<pad>")]
+            except ValueError:
+                pass
+
     return sentences
 
 
@@ -247,14 +304,92 @@ def tripl2list(tripl):
 
 
 
+# Cache of the BERT features per triplet: the triplets come from a fixed
+# vocabulary, so each unique one only needs a single encoder forward
+_tripl_feat_cache = {}
+
+def _tripl_features(words, model, tokenizer):
+    '''
+    Return the (num_words, hidden_size) BERT pooler features of a triplet,
+    running the encoder only the first time each unique triplet is seen.
+
+    Args:
+        words: list of the words of the triplet
+        model (torch.nn.Module): model used for extracting the features
+        tokenizer: tokenizer matching the model
+
+    Return:
+        feats (torch.Tensor): features for each word of the triplet
+    '''
+    key = str(words)
+    feats = _tripl_feat_cache.get(key)
+    if feats is None:
+        encoded_input = tokenizer(words, return_tensors='pt', add_special_tokens=False, padding=True)
+        device = next(model.parameters()).device
+        output = model(**encoded_input.to(device))
+        feats = output.pooler_output.detach().cpu()
+        _tripl_feat_cache[key] = feats
+    return feats
+
+
+# Cache of the parsed graph structure per triplet set: the classifier draws
+# from a fixed triplet vocabulary, so the same sets come back step after step
+# and the string munging only needs to happen once
+_parse_cache = {}
+
+def _parse_sample(sample):
+    '''
+    Pure-parsing step of tripl2graph, memoized per unique triplet set:
+    builds the edge lists and records which cached BERT row backs each node.
+
+    Args:
+        sample: tuple with the triplet strings of one sample
+
+    Return:
+        src_ids, dst_ids: source and destination node ids of the edges
+        node_refs: one (triplet words, row) pair per node of the graph
+    '''
+    parsed = _parse_cache.get(sample)
+    if parsed is not None:
+        return parsed
+    tmp_dict = {}
+    tmp_id = 0
+    src_ids = []
+    dst_ids = []
+    node_refs = []
+    for tripl in sample:
+        words = tripl2list(tripl)
+        if tripl[0] not in tmp_dict:
+            tmp_dict[tripl[0]]=tmp_id
+            tmp_id+=1
+            node_refs.append((words, 0))
+        if tripl[1] not in tmp_dict:
+            tmp_dict[tripl[1]]=tmp_id
+            tmp_id+=1
+            node_refs.append((words, 1))
+        if tripl[2] not in tmp_dict:
+            tmp_dict[tripl[2]]=tmp_id
+            tmp_id+=1
+            node_refs.append((words, 2))
+
+        # Create source and destination lists
+        src_ids.append(tmp_dict[tripl[0]])
+        dst_ids.append(tmp_dict[tripl[1]])
+        src_ids.append(tmp_dict[tripl[1]])
+        dst_ids.append(tmp_dict[tripl[2]])
+    parsed = (src_ids, dst_ids, node_refs)
+    _parse_cache[sample] = parsed
+    return parsed
+
+
 def tripl2graph(triplets, model, tokenizer):
     '''
     Function that creates and extracts the graph from the triplets
-    
+
     Args:
         triplets List[List]: list of lists of triplets
         model (torch.nn.Module): model used for extracting the features from the nodes
-        
+
     Return:
         graph List[dgl.DGLGraph]: list of graphs
         graph_features List[torch.Tensor]: list of features for each graph
@@ -262,36 +397,11 @@ def tripl2graph(triplets, model, tokenizer):
     feats = []
     graphs = []
     for sample in triplets:
-        tmp_dict = {}
-        tmp_id = 0
-        tmp_src_ids = []
-        tmp_dst_ids = []
-        tmp_node_feats = []
-        # Extract features from triplets
-        for _, tripl in enumerate(sample):
-            encoded_input = tokenizer(tripl2list(tripl), return_tensors='pt', add_special_tokens=False, padding=True)
-            output = model(**encoded_input.to('cuda:0'))
-            if tripl[0] not in list(tmp_dict.keys()):
-                tmp_dict[tripl[0]]=tmp_id
-                tmp_id+=1
-                tmp_node_feats.append(list(output.pooler_output[0]))
-            if tripl[1] not in list(tmp_dict.keys()):
-                tmp_dict[tripl[1]]=tmp_id
-                tmp_id+=1
-                tmp_node_feats.append(list(output.pooler_output[1]))
-            if tripl[2] not in list(tmp_dict.keys()):
-                tmp_dict[tripl[2]]=tmp_id
-                tmp_id+=1
-                tmp_node_feats.append(list(output.pooler_output[2]))
-                
-            # Create source and destination lists
-            tmp_src_ids.append(tmp_dict[tripl[0]])
-            tmp_dst_ids.append(tmp_dict[tripl[1]])
-            tmp_src_ids.append(tmp_dict[tripl[1]])
-            tmp_dst_ids.append(tmp_dict[tripl[2]])
-        
+        # Parsing is memoized per triplet set; the node features are a
+        # gather over the cached BERT rows, so no encoder runs per step
+        tmp_src_ids, tmp_dst_ids, node_refs = _parse_sample(tuple(sample))
         g = dgl.graph((tmp_src_ids, tmp_dst_ids))
-        f = torch.Tensor(tmp_node_feats)
+        f = torch.stack([_tripl_features(words, model, tokenizer)[row] for words, row in node_refs])
         graphs.append(g)
         feats.append(f)
     
@@ -320,32 +430,30 @@ def tripl2graphw(triplets, model, tokenizer):
     '''
     feats = []
     graphs = []
-    model = model.to('cuda:0')
     for sample in triplets:
         tmp_dict = {}
         tmp_id = 0
         tmp_src_ids = []
         tmp_dst_ids = []
         tmp_node_feats = []
-        # Extract features from triplets
+        # Extract features from triplets (cached per unique triplet)
         for _, tripl in enumerate(sample):
             for t in tripl:
-                encoded_input = tokenizer(t, return_tensors='pt', add_special_tokens=False, padding=True)
-                output = model(**encoded_input.to('cuda:0'))
+                pooled = _tripl_features(t, model, tokenizer)
                 # If the tripl is "normal" i.e. there are relations in the sentence
                 if len(t) == 3:
                     if t[0] not in list(tmp_dict.keys()):
                         tmp_dict[t[0]]=tmp_id
                         tmp_id+=1
-                        tmp_node_feats.append(list(output.pooler_output[0]))
+                        tmp_node_feats.append(list(pooled[0]))
                     if t[1] not in list(tmp_dict.keys()):
                         tmp_dict[t[1]]=tmp_id
                         tmp_id+=1
-                        tmp_node_feats.append(list(output.pooler_output[1]))
+                        tmp_node_feats.append(list(pooled[1]))
                     if t[2] not in list(tmp_dict.keys()):
                         tmp_dict[t[2]]=tmp_id
                         tmp_id+=1
-                        tmp_node_feats.append(list(output.pooler_output[2]))
+                        tmp_node_feats.append(list(pooled[2]))
                     
                     # Create source and destination lists
                     tmp_src_ids.append(tmp_dict[t[0]])
@@ -357,7 +465,7 @@ def tripl2graphw(triplets, model, tokenizer):
                     if t[0] not in list(tmp_dict.keys()):
                         tmp_dict[t[0]]=tmp_id
                         tmp_id+=1
-                        tmp_node_feats.append(list(output.pooler_output[0]))
+                        tmp_node_feats.append(list(pooled[0]))
                     tmp_src_ids.append(tmp_dict[t[0]])
                     tmp_dst_ids.append(tmp_dict[t[0]])
         
@@ -420,6 +528,22 @@ def load_json(path):
     return data
 
 
+def dump_json(data, path):
+    '''
+    Simple function to save a json, using orjson when available
+
+    Args:
+        data: data to serialize
+        path: path to the output file
+    '''
+    if orjson is not None:
+        with open(path, 'wb') as f:
+            f.write(orjson.dumps(data))
+    else:
+        with open(path, 'w') as f:
+            json.dump(data, f)
+
+
 def bleuFormat(filename):
     '''
     Function that converts the output json produced by the testing; into an
@@ -445,8 +569,7 @@ def bleuFormat(filename):
             new_data[k] = caption
         return new_data
     ucm = renew(ucm)
-    with open(filename, 'w') as f:
-        json.dump(ucm, f)
+    dump_json(ucm, filename)
 
 
 def load_graph_data(graph_path, split):
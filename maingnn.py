@@ -4,12 +4,38 @@ from train import caption_trainer, classifier_trainer, augmented_caption_trainer
 from eval import eval_captions, augmented_eval_captions, eval_classification, eval_pipeline, eval_waterfall
 from graph_utils import save_plots, produce_graphs
 import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
 import os
 # Imports for waterfall pipeline
 import pickle
 from models import TextGenerator
 
 
+def setup_distributed():
+    '''
+    Initialize torch.distributed when the script is launched through torchrun
+    (one process per GPU); fall back to the usual single-device path otherwise.
+
+    Return:
+        device: device of the current process, or None outside torchrun
+    '''
+    if 'LOCAL_RANK' not in os.environ or not torch.cuda.is_available():
+        return None
+    local_rank = int(os.environ['LOCAL_RANK'])
+    torch.cuda.set_device(local_rank)
+    dist.init_process_group(backend='nccl')
+    return torch.device('cuda', local_rank)
+
+
+def teardown_distributed():
+    '''
+    Tear down the process group created by setup_distributed, if any.
+    '''
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
+
+
 def train_gnn(dataset, task, epochs, lr, batch_size, decoder, network_name, early_stopping, threshold, gnn, vir, depth, attributes, plot, combo, pil):
     '''
     Function that initialize the training for the gnn depending on the task and dataset
@@ -66,8 +92,14 @@ def train_gnn(dataset, task, epochs, lr, batch_size, decoder, network_name, earl
         if val_dataset.max_capt_length>max:
             max = val_dataset.max_capt_length
         model = CaptionGenerator(feats_n, max, train_dataset.word2idx, gnn=gnn, vir=vir, depth=depth, decoder=decoder)
-        trainer = caption_trainer(model,train_dataset,val_dataset,collate_fn_captions, train_dataset.word2idx, max, network_name)
-        trainer.fit(epochs, lr, batch_size, model._loss, early_stopping=early_stopping, tol_threshold=threshold)
+        # Keep the loss of the raw model: DDP only wraps the forward
+        criterion = model._loss
+        device = setup_distributed()
+        if device is not None:
+            # Gradient AllReduce overlaps with backward, one process per GPU
+            model = DDP(model.to(device), device_ids=[device.index])
+        trainer = caption_trainer(model,train_dataset,val_dataset,collate_fn_captions, train_dataset.word2idx, max, network_name, device=device)
+        trainer.fit(epochs, lr, batch_size, criterion, early_stopping=early_stopping, tol_threshold=threshold)
     elif task == "img2tripl":
         if dataset == 'ucm':
             train_filenames = 'dataset/UCM_dataset/filenames/filenames_train.txt'
@@ -177,8 +209,7 @@ def train_gnn(dataset, task, epochs, lr, batch_size, decoder, network_name, earl
         max = train_dataset.max_capt_length
         if val_dataset.max_capt_length>max:
             max = val_dataset.max_capt_length
-        img_encoder = TripletClassifier(img_dim,len(train_dataset.triplet_to_idx), pil)
-        model = FinalModel(img_encoder, feats_n, max, train_dataset.word2idx, img_dim, train_dataset.triplet_to_idx, gnn=gnn, vir=vir, depth=depth, decoder=decoder, pil=pil)
+        model = FinalModel(feats_n, max, train_dataset.word2idx, img_dim, train_dataset.triplet_to_idx, gnn=gnn, vir=vir, depth=depth, decoder=decoder, pil=pil)
         trainer = full_pipeline_trainer(model,train_dataset,val_dataset, collate_fn_full, train_dataset.word2idx, max, network_name, pil=pil)
         if not plot:
             trainer.fit(epochs, lr, batch_size, model._loss, early_stopping=early_stopping, tol_threshold=threshold, plot=False, combo=combo)
@@ -404,8 +435,7 @@ def test_gnn(dataset, task, decoder, network_name, filename, gnn, vir, depth, at
         
         feats_n = torch.Tensor(test_dataset.node_feats[list(test_dataset.node_feats.keys())[0]])[0].size(0)
         max = test_dataset.max_capt_length
-        img_encoder = TripletClassifier(img_dim,len(test_dataset.triplet_to_idx))
-        model = FinalModel(img_encoder, feats_n, max, test_dataset.word2idx, img_dim, test_dataset.triplet_to_idx, gnn=gnn, vir=vir, depth=depth, decoder=decoder)
+        model = FinalModel(feats_n, max, test_dataset.word2idx, img_dim, test_dataset.triplet_to_idx, gnn=gnn, vir=vir, depth=depth, decoder=decoder)
         model = torch.load(network_name)
         eval_pipeline(test_dataset, model, filename, pil)
 
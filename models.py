@@ -1,12 +1,14 @@
 from cProfile import label
 from turtle import forward
+import functools
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torchvision.models import resnet152, ResNet152_Weights, VGG16_Weights, vgg16
 from torch.nn.utils.rnn import pack_padded_sequence
 from gnn import GNN, LSTMDecoder, encode_seq_to_arr_loss, decoderRNN, MLAPModel, fixed_seq_to_arr
 from transformers import BertModel, BertTokenizer
-from graph_utils import tripl2graph
+from graph_utils import tripl2graph, invert_vocab
 
 class TripletClassifier(nn.Module):
     '''
@@ -20,7 +22,10 @@ class TripletClassifier(nn.Module):
         self.num_classes = num_classes
         weights = ResNet152_Weights.DEFAULT
         self.model = resnet152(weights=weights)
-        self.preprocess = weights.transforms()
+        # ImageNet normalization as on-device buffers; the torchvision
+        # transforms pipeline forced a CPU round trip on every forward
+        self.register_buffer('mean', torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1))
+        self.register_buffer('std', torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1))
         # Replace the last layer with a new layer for classification
         self.model.fc = nn.Sequential(
             nn.Linear(in_features=2048,out_features=1024),
@@ -39,11 +44,27 @@ class TripletClassifier(nn.Module):
         '''
         assert x.shape[2]==self.input_size
         assert x.shape[3]==self.input_size
-        
-        return self.model(self.preprocess(x))
+
+        return self.model((x - self.mean) / self.std)
 
 def load_model(path):
     return torch.load(path)
+
+
+@functools.lru_cache(maxsize=1)
+def _load_bert():
+    '''
+    Load the frozen BERT encoder and tokenizer used for the node features.
+    The lru_cache makes every caller share a single copy of the weights
+    instead of re-loading ~440MB per model instance.
+    '''
+    model = BertModel.from_pretrained("bert-base-uncased").eval()
+    model.requires_grad_(False)
+    if torch.cuda.is_available():
+        # tripl2graph moves its inputs to cuda:0, so keep the encoder there too
+        model = model.to('cuda:0')
+    tokenizer = BertTokenizer.from_pretrained("bert-base-uncased")
+    return model, tokenizer
     
 class CaptionGenerator(nn.Module):
     '''
@@ -71,7 +92,7 @@ class CaptionGenerator(nn.Module):
             self.decoder = decoderRNN(feats_dim, vocab2idx, feats_dim, 1, max_seq_len)
         self.dropout = nn.Dropout(p=0.3)
         self.vocab2idx = vocab2idx
-        self.idx2vocab = {v: k for k, v in vocab2idx.items()}
+        self.idx2vocab = invert_vocab(vocab2idx)
 
     def forward(self, g, feats, labels, lengths, training):
         graph_feats = self.dropout(self.encoder(g, feats))
@@ -98,14 +119,18 @@ class CaptionGenerator(nn.Module):
             # c_loss = 0.0
             # for gt in batched_label:
             #     c_loss += nn.CrossEntropyLoss(ignore_index=vocab2idx['<pad>'])(out, gt.to(device=device))
-            c_loss = nn.CrossEntropyLoss(ignore_index=vocab2idx['<pad>'])(out, targets.to(device=device))
+            c_loss = F.cross_entropy(out, targets.to(device=device), ignore_index=vocab2idx['<pad>'])
             # return c_loss/batched_label.shape[0]# Mean of the losses for each of the 5 captions
             return c_loss
-            
+
         else:
             batched_label = torch.vstack([encode_seq_to_arr_loss(label, vocab2idx, max_seq_len) for label in labels])
-            return sum([nn.CrossEntropyLoss(ignore_index=vocab2idx['<pad>'])(out[i], batched_label[:, i].to(device=device)) for i in range(max_seq_len)])/max_seq_len
-    
+            # One fused cross entropy over every token position instead of
+            # max_seq_len separate loss kernels and host->device copies
+            logits = torch.stack(out, dim=1).flatten(0, 1) # (batch_size*max_seq_len, vocab_len)
+            targets = batched_label[:, :max_seq_len].to(device=device).flatten()
+            return F.cross_entropy(logits, targets, ignore_index=vocab2idx['<pad>'])
+
     def sample(self, graph, graph_feats):
         self.eval()
         with torch.no_grad():
@@ -153,7 +178,7 @@ class AugmentedCaptionGenerator(nn.Module):
             self.decoder = decoderRNN(feats_dim, len(vocab2idx), feats_dim, 3)
         self.dropout = nn.Dropout(p=0.3)
         self.vocab2idx = vocab2idx
-        self.idx2vocab = {v: k for k, v in vocab2idx.items()}
+        self.idx2vocab = invert_vocab(vocab2idx)
 
     def forward(self, g, g_feats, img, labels=None):
         i_feats = self.img_encoder(img)
@@ -171,14 +196,20 @@ class AugmentedCaptionGenerator(nn.Module):
 
     def _loss(self, out, labels, vocab2idx, max_seq_len, device) -> torch.Tensor:
         batched_label = torch.vstack([encode_seq_to_arr_loss(label, vocab2idx, max_seq_len) for label in labels])
-        return sum([nn.CrossEntropyLoss()(out[i], batched_label[:, i].to(device=device)) for i in range(max_seq_len)])/max_seq_len
-    
+        # One fused cross entropy over every token position instead of
+        # max_seq_len separate loss kernels and host->device copies
+        logits = torch.stack(out, dim=1).flatten(0, 1) # (batch_size*max_seq_len, vocab_len)
+        targets = batched_label[:, :max_seq_len].to(device=device).flatten()
+        return F.cross_entropy(logits, targets)
+
 
 
 class MultiHead(torch.nn.Module):
     '''
-    Class for the multihead classifier for the triplet prediction
-    
+    Class for the multihead classifier for the triplet prediction.
+    Kept as a compatibility shim so old checkpoints still unpickle;
+    new models use the fused single-Linear head below.
+
     Args:
         backbone (torch.nn.Module): backbone for the images
         heads List[torch.nn.Module]: list of heads for the tasks
@@ -204,9 +235,14 @@ class MultiHeadClassifier(nn.Module):
         self.input_size = input_size
         weights = ResNet152_Weights.DEFAULT
         self.backbone = resnet152(weights=weights)
-        self.preprocess = weights.transforms()
-        classifiers = [torch.nn.Linear(2048, 2) for _ in range(dict_size)]
-        self.backbone.fc = MultiHead(torch.nn.Identity(), classifiers)
+        # ImageNet normalization as on-device buffers; the torchvision
+        # transforms pipeline forced a CPU round trip on every forward
+        self.register_buffer('mean', torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1))
+        self.register_buffer('std', torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1))
+        # One fused head: a single (2048 -> 2*dict_size) linear is mathematically
+        # identical to dict_size separate Linear(2048, 2) heads concatenated on
+        # dim 1, but runs as one GEMM instead of dict_size tiny launches
+        self.backbone.fc = torch.nn.Linear(2048, 2*dict_size)
         # Freeze all the layers except the fully connected
         for name, parameter in self.backbone.named_parameters():
             if(not 'fc' in name):
@@ -216,9 +252,9 @@ class MultiHeadClassifier(nn.Module):
         
         assert img.shape[2]==self.input_size
         assert img.shape[3]==self.input_size
-        
-        features = self.backbone(self.preprocess(img))
-        
+
+        features = self.backbone((img - self.mean) / self.std)
+
         return features
     
 class FinalModel(nn.Module):
@@ -231,26 +267,36 @@ class FinalModel(nn.Module):
         vocab2idx: dictionary for one hot encoding of tokens
         decoder: type of decoder (linear, lstm or rnn)
     '''
-    def __init__(self, img_encoder, feats_dim, max_seq_len, vocab2idx, img_dim, tripl2idx, gnn='gat', res=False, vir=True, depth=1, decoder='lstm', pil=False) -> None:
+    def __init__(self, feats_dim, max_seq_len, vocab2idx, img_dim, tripl2idx, gnn='gat', res=False, vir=True, depth=1, decoder='lstm', pil=False) -> None:
         super(FinalModel, self).__init__()
         self.max_seq_len = max_seq_len
+        self.pil = pil
+        self.input_size = img_dim
         if gnn == 'gat' or gnn == 'gcn':
             self.graph_encoder = GNN(feats_dim, gnn)
         elif gnn == 'mlap':
             self.graph_encoder = MLAPModel(res, vir, feats_dim, depth)
-        self.tripl_classifier = MultiHeadClassifier(img_dim, len(tripl2idx),pil)
-        # self.tripl_classifier = TripletClassifier(img_dim, len(tripl2idx), pil)
+        # One shared frozen ResNet-152: both the triplet classification and
+        # the image features come from a single backbone pass, instead of two
+        # full copies of the network running on the same image
+        weights = ResNet152_Weights.DEFAULT
+        self.backbone = resnet152(weights=weights)
+        self.backbone.fc = nn.Identity()
+        for parameter in self.backbone.parameters():
+            parameter.requires_grad = False
+        # ImageNet normalization as on-device buffers; the torchvision
+        # transforms pipeline forced a CPU round trip on every forward
+        self.register_buffer('mean', torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1))
+        self.register_buffer('std', torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1))
+        # Per-task heads on top of the shared features
+        self.triplet_head = nn.Linear(2048, 2*len(tripl2idx))
+        self.img_head = nn.Linear(2048, feats_dim)
         self.sigmoid = nn.Sigmoid()
-        self.idx2tripl = {v: k for k, v in tripl2idx.items()}
-        self.feature_encoder = BertModel.from_pretrained("bert-base-uncased")
-        self.tokenizer = BertTokenizer.from_pretrained("bert-base-uncased")
-        # Incorporate image in the pipeline
-        self.img_encoder = img_encoder
-        self.img_encoder.model.fc = nn.Linear(2048, feats_dim)
-        # Freeze all the layers except the fully connected
-        for name, parameter in self.img_encoder.named_parameters():
-            if(not 'fc' in name):
-                parameter.requires_grad = False
+        self.idx2tripl = invert_vocab(tripl2idx)
+        # Shared frozen BERT; stored as a plain attribute so its weights are
+        # not registered as a submodule and saved inside every checkpoint
+        feature_encoder, self.tokenizer = _load_bert()
+        self.__dict__['feature_encoder'] = feature_encoder
 
         # Initialize the weight at a random value
         self.img_weight = torch.nn.parameter.Parameter(torch.randn(1, requires_grad=True))
@@ -266,21 +312,43 @@ class FinalModel(nn.Module):
             self.decoder = decoderRNN(feats_dim*2, vocab2idx, feats_dim*2, 1, self.max_seq_len)
         self.dropout = nn.Dropout(p=0.3)
         self.vocab2idx = vocab2idx
-        self.idx2vocab = {v: k for k, v in vocab2idx.items()}
+        self.idx2vocab = invert_vocab(vocab2idx)
+
+    def __getstate__(self):
+        '''
+        Drop the shared frozen BERT from the pickle: torch.save of the whole
+        model would otherwise embed its ~440MB in every checkpoint
+        '''
+        state = self.__dict__.copy()
+        del state['feature_encoder']
+        return state
+
+    def __setstate__(self, state):
+        '''
+        Re-attach the shared frozen BERT after unpickling
+        '''
+        self.__dict__.update(state)
+        self.__dict__['feature_encoder'] = _load_bert()[0]
 
-    def forward(self, img, captions, labels=None, lengths=None, training=False):
+    def forward(self, img, captions=None, labels=None, lengths=None, training=False):
+        assert img.shape[2]==self.input_size
+        assert img.shape[3]==self.input_size
+        # Single backbone pass shared by both heads
+        img_feats = self.backbone((img - self.mean) / self.std)
         # Triplet classification
-        triplets = self.sigmoid(self.tripl_classifier(img))
+        triplets = self.sigmoid(self.triplet_head(img_feats))
         # For normal classifier
         # class_out = triplets
         # # For multihead classifier
         triplets = triplets.reshape((triplets.shape[0], int(triplets.shape[1]/2), 2))
         class_out = triplets
-        triplets = [[torch.argmax(logits).item() for logits in img] for img in triplets]
         # # Changed for BCE loss
-        # Extract indeces greater or equal than the threshold
-        threshold = 0.5
-        indeces = [[ i for i, d in enumerate(s) if d >= threshold] for s in triplets ]
+        # Vectorized argmax stays on device; a single .nonzero().cpu() sync
+        # extracts the predicted triplet ids for the whole batch
+        preds = triplets.argmax(dim=-1) # (batch_size, num_triplets)
+        indeces = [[] for _ in range(preds.shape[0])]
+        for sample, idx in preds.nonzero(as_tuple=False).cpu().tolist():
+            indeces[sample].append(idx)
         # Extract the triplets
         triplets = [[self.idx2tripl[i] for i in s] for s in indeces]
         # Add "proxy" triplets due to the fact that the network can't process void triplets
@@ -290,7 +358,7 @@ class FinalModel(nn.Module):
         
         # Retrieve the graph and graph features
         graph, graph_feats = tripl2graph(triplets, self.feature_encoder, self.tokenizer)
-        i_feats = self.img_encoder(img)
+        i_feats = self.img_head(img_feats)
         graph, graph_feats = graph.to(img.device), graph_feats.to(img.device)
         graph_feats = self.dropout(self.graph_encoder(graph, graph_feats))
         # Mod feats with concatenation
@@ -312,13 +380,16 @@ class FinalModel(nn.Module):
     def sample(self, img):
         self.eval()
         with torch.no_grad():
-            triplets = self.sigmoid(self.tripl_classifier(img))
+            # Single backbone pass shared by both heads
+            img_feats = self.backbone((img - self.mean) / self.std)
+            triplets = self.sigmoid(self.triplet_head(img_feats))
             triplets = triplets.reshape((triplets.shape[0], int(triplets.shape[1]/2), 2))
-            triplets = [[torch.argmax(logits).item() for logits in img] for img in triplets]
             # # Changed for BCE loss
-            # Extract indeces greater or equal than the threshold
-            threshold = 0.5
-            indeces = [[ i for i, d in enumerate(s) if d >= threshold] for s in triplets ]
+            # Vectorized argmax stays on device; one sync for the whole batch
+            preds = triplets.argmax(dim=-1) # (batch_size, num_triplets)
+            indeces = [[] for _ in range(preds.shape[0])]
+            for sample, idx in preds.nonzero(as_tuple=False).cpu().tolist():
+                indeces[sample].append(idx)
             # Extract the triplets
             triplets = [[self.idx2tripl[i] for i in s] for s in indeces]
             # Add "proxy" triplets due to the fact that the network can't process void triplets
@@ -327,7 +398,7 @@ class FinalModel(nn.Module):
                     s.append("('There', 'is', 'no triplet')")
             # Retrieve the graph and graph features
             graph, graph_feats = tripl2graph(triplets, self.feature_encoder, self.tokenizer)
-            i_feats = self.img_encoder(img)
+            i_feats = self.img_head(img_feats)
             graph, graph_feats = graph.to(img.device), graph_feats.to(img.device)
             graph_feats = self.dropout(self.graph_encoder(graph, graph_feats))
             # Mod feats with concatenation
@@ -351,14 +422,18 @@ class FinalModel(nn.Module):
             # c_loss = 0.0
             # for gt in batched_label:
             #     c_loss += nn.CrossEntropyLoss(ignore_index=vocab2idx['<pad>'])(out, gt.to(device=device))
-            c_loss = nn.CrossEntropyLoss(ignore_index=vocab2idx['<pad>'])(out, targets.to(device=device))
+            c_loss = F.cross_entropy(out, targets.to(device=device), ignore_index=vocab2idx['<pad>'])
             # return c_loss/batched_label.shape[0]# Mean of the losses for each of the 5 captions
             return c_loss
-            
+
         else:
             batched_label = torch.vstack([encode_seq_to_arr_loss(label, vocab2idx, max_seq_len) for label in labels])
-            return sum([nn.CrossEntropyLoss(ignore_index=vocab2idx['<pad>'])(out[i], batched_label[:, i].to(device=device)) for i in range(max_seq_len)])/max_seq_len
-        
+            # One fused cross entropy over every token position instead of
+            # max_seq_len separate loss kernels and host->device copies
+            logits = torch.stack(out, dim=1).flatten(0, 1) # (batch_size*max_seq_len, vocab_len)
+            targets = batched_label[:, :max_seq_len].to(device=device).flatten()
+            return F.cross_entropy(logits, targets, ignore_index=vocab2idx['<pad>'])
+
         print("\n",batched_label.shape)
         print(out.shape)
         
@@ -384,11 +459,29 @@ class FinetunedModel(nn.Module):
         super(FinetunedModel, self).__init__()
         self.decoder = torch.load(decoder)
         self.tripl_classifier = MultiHeadClassifier(img_dim, len(tripl2idx))
-        self.idx2tripl = {v: k for k, v in tripl2idx.items()}
-        self.feature_encoder = BertModel.from_pretrained("bert-base-uncased")
-        self.tokenizer = BertTokenizer.from_pretrained("bert-base-uncased")
+        self.idx2tripl = invert_vocab(tripl2idx)
+        # Shared frozen BERT; stored as a plain attribute so its weights are
+        # not registered as a submodule and saved inside every checkpoint
+        feature_encoder, self.tokenizer = _load_bert()
+        self.__dict__['feature_encoder'] = feature_encoder
         self.vocab2idx = vocab2idx
-        self.idx2vocab = {v: k for k, v in vocab2idx.items()}
+        self.idx2vocab = invert_vocab(vocab2idx)
+
+    def __getstate__(self):
+        '''
+        Drop the shared frozen BERT from the pickle: torch.save of the whole
+        model would otherwise embed its ~440MB in every checkpoint
+        '''
+        state = self.__dict__.copy()
+        del state['feature_encoder']
+        return state
+
+    def __setstate__(self, state):
+        '''
+        Re-attach the shared frozen BERT after unpickling
+        '''
+        self.__dict__.update(state)
+        self.__dict__['feature_encoder'] = _load_bert()[0]
 
     def forward(self, img):
         # Triplet classification
@@ -396,10 +489,11 @@ class FinetunedModel(nn.Module):
         # For multihead classifier
         triplets = triplets.reshape((triplets.shape[0], int(triplets.shape[1]/2), 2))
         class_out = triplets
-        triplets = [[torch.argmax(logits).item() for logits in img] for img in triplets]
-        # Extract indeces greater or equal than the threshold
-        threshold = 0.5
-        indeces = [[ i for i, d in enumerate(s) if d >= threshold] for s in triplets ]
+        # Vectorized argmax stays on device; one sync for the whole batch
+        preds = triplets.argmax(dim=-1) # (batch_size, num_triplets)
+        indeces = [[] for _ in range(preds.shape[0])]
+        for sample, idx in preds.nonzero(as_tuple=False).cpu().tolist():
+            indeces[sample].append(idx)
         # Extract the triplets
         triplets = [[self.idx2tripl[i] for i in s] for s in indeces]
         # Add "proxy" triplets due to the fact that the network can't process void triplets
@@ -420,7 +514,11 @@ class FinetunedModel(nn.Module):
 
     def _loss(self, out, labels, vocab2idx, max_seq_len, device) -> torch.Tensor:
         batched_label = torch.vstack([encode_seq_to_arr_loss(label, vocab2idx, max_seq_len) for label in labels])
-        return sum([nn.CrossEntropyLoss()(out[i], batched_label[:, i].to(device=device)) for i in range(max_seq_len)])/max_seq_len
+        # One fused cross entropy over every token position instead of
+        # max_seq_len separate loss kernels and host->device copies
+        logits = torch.stack(out, dim=1).flatten(0, 1) # (batch_size*max_seq_len, vocab_len)
+        targets = batched_label[:, :max_seq_len].to(device=device).flatten()
+        return F.cross_entropy(logits, targets)
 
 
 # Normal caption generator implemented by Riccardo
@@ -1,6 +1,6 @@
 import argparse
 
-from maingnn import train_gnn, test_gnn
+from maingnn import train_gnn, test_gnn, teardown_distributed
 
 parser = argparse.ArgumentParser(description="Extract triplets from dataset's captions.")
 parser.add_argument('--dataset', type=str,            default='ucm',           required=False, help='Name of the dataset of which you want to create the triplets.')
@@ -54,4 +54,5 @@ if __name__=="__main__":
                 args.plt,
                 args.combo,
                 args.pil
-                )
\ No newline at end of file
+                )
+        teardown_distributed()
\ No newline at end of file
@@ -1,4 +1,6 @@
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+import torch.distributed as dist
 from torchmetrics.functional import f1_score
 from functools import partial
 import torch.nn as nn
@@ -7,7 +9,7 @@ import torch.optim as optim
 import torch
 import dgl
 from graph_utils import get_node_features, tripl2graph, tripl2graphw
-from transformers import BertModel, BertTokenizer
+from models import _load_bert
 
 
 def multitask_loss(criterion, outputs, targets):
@@ -184,8 +186,13 @@ class caption_trainer():
         self.device = device
     
     def fit(self, epochs, learning_rate, batch_size, criterion, early_stopping=False, tol_threshold=5):
-        # Define dataloader
-        trainloader = DataLoader(self.dataset_train, batch_size=batch_size, shuffle=True, collate_fn=partial(self.collate_fn, word2idx=self.word2idx, training=True))
+        # Define dataloader; under torchrun each rank trains on its own shard
+        distributed = dist.is_available() and dist.is_initialized()
+        if distributed:
+            train_sampler = DistributedSampler(self.dataset_train)
+            trainloader = DataLoader(self.dataset_train, batch_size=batch_size, sampler=train_sampler, collate_fn=partial(self.collate_fn, word2idx=self.word2idx, training=True))
+        else:
+            trainloader = DataLoader(self.dataset_train, batch_size=batch_size, shuffle=True, collate_fn=partial(self.collate_fn, word2idx=self.word2idx, training=True))
         if self.dataset_val!='':
             valloader = DataLoader(self.dataset_val,batch_size=1,shuffle=False,collate_fn=partial(self.collate_fn, word2idx=self.word2idx, training=True))
         # Define the optimizer
@@ -197,6 +204,9 @@ class caption_trainer():
             train_max = float('inf')
             tollerance = 0
         for epoch in range(epochs):
+            if distributed:
+                # Reshuffle the shards with a different seed each epoch
+                train_sampler.set_epoch(epoch)
             self.model.train()
             epoch_loss_train = 0
             epoch_loss_val = 0
@@ -221,7 +231,14 @@ class caption_trainer():
                         outputs = self.model(graphs, feats, encoded_captions)
                         loss = criterion(outputs, captions, self.word2idx, encoded_captions.size(1), self.device)
                         epoch_loss_val+=loss.item()
-                    
+
+            if distributed:
+                # Average the epoch losses across the ranks so every process
+                # takes the same early-stopping decision; a per-rank break
+                # would leave the others hanging in the gradient allreduce
+                losses = torch.tensor([epoch_loss_train, epoch_loss_val], device=self.device)
+                dist.all_reduce(losses, op=dist.ReduceOp.AVG)
+                epoch_loss_train, epoch_loss_val = losses.tolist()
             print('Training loss: {:.3f}'.format(epoch_loss_train/i))
             if self.dataset_val!='':
                 print('Validation loss: {:.3f}'.format(epoch_loss_val/j))
@@ -238,12 +255,12 @@ class caption_trainer():
                     # Restart from the best checkpoint
                     self.model = best_model
         
-        if early_stopping:
-            torch.save(best_model,self.save_path)
-        else:
-            torch.save(self.model,self.save_path)
-            
-            
+        # Save the plain network (without the DDP wrapper), once per job
+        final_model = best_model if early_stopping else self.model
+        if (not distributed) or dist.get_rank() == 0:
+            torch.save(getattr(final_model, 'module', final_model), self.save_path)
+
+
 class augmented_caption_trainer():
     '''
     Class to train the caption inference on a dataset.
@@ -483,7 +500,7 @@ class enc_finetuning():
         # we will iterate through the layers of the network
         for name, param in self.model.named_parameters():
             if not name.startswith('feature_encoder'):
-                if name.startswith('tripl_classifier') and 'fc' in name:
+                if name.startswith('triplet_head'):
                     final_layer_weights.append(param)
                     # final_names.append(name)
                 else:
@@ -573,8 +590,8 @@ class waterfall_trainer():
     def __init__(self, model, dataset_train, dataset_val, collate_fn, word2idx, max_capt_length, save_path, use_cuda=True, device = None, pil=False):
         self.pil = pil
         self.model = model
-        self.feature_encoder = BertModel.from_pretrained("bert-base-uncased")
-        self.tokenizer = BertTokenizer.from_pretrained("bert-base-uncased")
+        # Shared frozen BERT (loaded once, cached across calls)
+        self.feature_encoder, self.tokenizer = _load_bert()
         self.dataset_train = dataset_train
         self.dataset_val = dataset_val
         self.save_path = save_path